@@ -0,0 +1,75 @@
+import logging
+import time
+
+
+class CircuitBreaker:
+	def __init__(self, threshold, cooldown):
+		self.threshold = threshold
+		self.cooldown = cooldown
+
+		## consecutive failures for each host
+		self.failures = {}
+
+		## time the circuit for a host was opened and hosts with a probe running
+		self.opened = {}
+		self.probing = set()
+
+
+	@property
+	def stats(self):
+		return {
+			'threshold': self.threshold,
+			'cooldown': self.cooldown,
+			'open': sorted(self.opened),
+			'failing': len(self.failures)
+		}
+
+
+	def get_wait(self, host):
+		## returns how long until a request to the host may be sent again
+		try:
+			opened = self.opened[host]
+
+		except KeyError:
+			return 0
+
+		if host in self.probing:
+			return self.cooldown
+
+		return max(0, opened + self.cooldown - time.monotonic())
+
+
+	def is_failing(self, host):
+		return host in self.failures or host in self.opened
+
+
+	def allow(self, host):
+		return self.get_wait(host) == 0
+
+
+	def start(self, host):
+		## the first request after the cooldown is a probe and the rest wait for its result
+		if host in self.opened:
+			self.probing.add(host)
+
+
+	def record_success(self, host):
+		self.failures.pop(host, None)
+		self.probing.discard(host)
+
+		if self.opened.pop(host, None):
+			logging.verbose(f'Closed circuit for {host}')
+
+
+	def record_failure(self, host):
+		self.probing.discard(host)
+
+		if host in self.opened:
+			self.opened[host] = time.monotonic()
+			return
+
+		self.failures[host] = self.failures.get(host, 0) + 1
+
+		if self.failures[host] >= self.threshold:
+			logging.verbose(f'Opened circuit for {host} after {self.failures[host]} failures')
+			self.opened[host] = time.monotonic()
@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import struct
+import time
+import traceback
+
+from cachetools import LRUCache
+from collections import deque
+
+from .misc import dump_json, write_file
+
+
+## chance of an object that hasn't been seen being taken for a duplicate by ObjectFilter
+FALSE_POSITIVE_RATE = 0.000001
+
+## number of filters an ObjectFilter checks ids against
+GENERATIONS = 2
+
+## ObjectFilter file header (magic, hash count, filter size) and filter header (created, count)
+FILTER_MAGIC = b'RLOF'
+FILTER_HEADER = struct.Struct('<4sII')
+GENERATION_HEADER = struct.Struct('<dQ')
+
+
+class RefreshCache:
+	def __init__(self, maxsize, ttl, negative_ttl, path=None, missing_ttl=None):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.missing_ttl = missing_ttl or negative_ttl
+		self.refreshing = set()
+
+		## entries are written to path, if set, so they survive a restart
+		self.path = path
+		self.dirty = False
+
+		## key -> (value, expire time)
+		self.data = LRUCache(maxsize)
+
+
+	def __contains__(self, key):
+		return key in self.data
+
+
+	def __len__(self):
+		return len(self.data)
+
+
+	def set(self, key, value):
+		## failed fetches are stored as None and documents that don't exist as False, both for
+		## a shorter time
+		if value is None:
+			ttl = self.negative_ttl
+
+		elif value is False:
+			ttl = self.missing_ttl
+
+		else:
+			ttl = self.ttl
+
+		self.data[key] = (value, time.time() + ttl)
+		self.dirty = True
+
+
+	def load(self):
+		if not self.path or not self.path.exists():
+			return
+
+		try:
+			with self.path.open() as fd:
+				entries = json.load(fd)
+
+		except (OSError, json.decoder.JSONDecodeError) as e:
+			logging.warning(f'Failed to load cache from {self.path}: {e}')
+			return
+
+		now = time.time()
+
+		for key, value, expires in entries:
+			if expires > now:
+				self.data[key] = (value, expires)
+
+
+	async def save(self):
+		if not self.path or not self.dirty:
+			return
+
+		self.dirty = False
+		entries = [(key, value, expires) for key, (value, expires) in self.data.items()]
+
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, dump_json, self.path, entries)
+
+		except OSError as e:
+			self.dirty = True
+			logging.warning(f'Failed to save cache to {self.path}: {e}')
+
+
+	async def fetch(self, key, fetcher):
+		value = await fetcher(key)
+		self.set(key, value)
+		return value
+
+
+	async def refresh(self, key, fetcher):
+		try:
+			value = await fetcher(key)
+
+			## a failed refresh keeps the stale value around and tries again after negative_ttl
+			## instead of throwing away something that worked until now
+			if value is None:
+				try:
+					value = self.data[key][0]
+
+				except KeyError:
+					return
+
+				self.data[key] = (value, time.time() + self.negative_ttl)
+				return
+
+			self.set(key, value)
+
+		except Exception:
+			traceback.print_exc()
+
+		finally:
+			self.refreshing.discard(key)
+
+
+	async def get(self, key, fetcher, force=False):
+		try:
+			value, expires = self.data[key]
+
+		except KeyError:
+			force = True
+
+		if force:
+			return await self.fetch(key, fetcher)
+
+		if time.time() < expires:
+			return value
+
+		## failed fetches are tried again right away once they expire
+		if value is None or value is False:
+			return await self.fetch(key, fetcher)
+
+		## serve the stale value while it gets refreshed in the background
+		if key not in self.refreshing:
+			logging.debug(f'Refreshing stale cache entry: {key}')
+			self.refreshing.add(key)
+			asyncio.ensure_future(self.refresh(key, fetcher))
+
+		return value
+
+
+class ObjectFilter:
+	## remembers the ids of relayed objects in bloom filters, which take about 3.6 MB per
+	## million ids. ids are added to the newest filter and checked against all of them. a
+	## new filter is started once the newest one is full or older than ttl and the oldest
+	## one is dropped, so an id is remembered for at least ttl unless more than capacity
+	## ids come in during that time
+
+	def __init__(self, capacity, ttl, path=None):
+		self.capacity = max(1, capacity)
+		self.ttl = ttl
+		self.path = path
+		self.dirty = False
+
+		bits = -self.capacity * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2
+		self.size = math.ceil(bits / 8)
+		self.bits = self.size * 8
+		self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+
+		## [created, count, filter] from oldest to newest
+		self.generations = deque(maxlen=GENERATIONS)
+		self.rotate()
+
+
+	def __contains__(self, object_id):
+		positions = self.get_positions(object_id)
+
+		for _, _, bits in self.generations:
+			if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+				return True
+
+		return False
+
+
+	def __len__(self):
+		return sum(count for _, count, _ in self.generations)
+
+
+	@property
+	def stats(self):
+		return {
+			'count': len(self),
+			'capacity': self.capacity,
+			'ttl': self.ttl,
+			'generations': len(self.generations),
+			'memory': self.size * len(self.generations)
+		}
+
+
+	def get_positions(self, object_id):
+		digest = hashlib.blake2b(object_id.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+
+		return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+
+	def rotate(self):
+		self.generations.append([time.time(), 0, bytearray(self.size)])
+
+
+	def add(self, object_id):
+		generation = self.generations[-1]
+
+		if generation[1] >= self.capacity or time.time() - generation[0] >= self.ttl:
+			self.rotate()
+			generation = self.generations[-1]
+
+		bits = generation[2]
+
+		for pos in self.get_positions(object_id):
+			bits[pos >> 3] |= 1 << (pos & 7)
+
+		generation[1] += 1
+		self.dirty = True
+
+
+	def load(self):
+		if not self.path or not self.path.exists():
+			return
+
+		try:
+			with self.path.open('rb') as fd:
+				magic, hashes, size = FILTER_HEADER.unpack(fd.read(FILTER_HEADER.size))
+
+				## the filters can't be used if they were made for a different capacity
+				if magic != FILTER_MAGIC or hashes != self.hashes or size != self.size:
+					logging.info(f'Ignoring saved object ids with different settings: {self.path}')
+					return
+
+				generations = []
+
+				while True:
+					header = fd.read(GENERATION_HEADER.size)
+
+					if not header:
+						break
+
+					created, count = GENERATION_HEADER.unpack(header)
+					bits = bytearray(fd.read(size))
+
+					if len(bits) != size:
+						raise ValueError('file is truncated')
+
+					generations.append([created, count, bits])
+
+		except (OSError, struct.error, ValueError) as e:
+			logging.warning(f'Failed to load object ids from {self.path}: {e}')
+			return
+
+		## a filter is only kept until the next one is older than ttl
+		now = time.time()
+		generations = [gen for gen in generations if now - gen[0] < self.ttl * GENERATIONS]
+
+		if generations:
+			self.generations.clear()
+			self.generations.extend(generations)
+
+
+	async def save(self):
+		if not self.path or not self.dirty:
+			return
+
+		self.dirty = False
+		data = bytearray(FILTER_HEADER.pack(FILTER_MAGIC, self.hashes, self.size))
+
+		for created, count, bits in self.generations:
+			data.extend(GENERATION_HEADER.pack(created, count))
+			data.extend(bits)
+
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, write_file, self.path, data)
+
+		except OSError as e:
+			self.dirty = True
+			logging.warning(f'Failed to save object ids to {self.path}: {e}')
@@ -4,6 +4,8 @@ import yaml
 from pathlib import Path
 from urllib.parse import urlparse
 
+from .policy import DomainPolicy
+
 
 relay_software_names = [
 	'activityrelay',
@@ -64,7 +66,57 @@ class RelayConfig(DotDict):
 	cachekeys = {
 		'json',
 		'objects',
-		'digests'
+		'actors',
+		'nodeinfo'
+	}
+
+	cachettlkeys = {
+		'key_ttl',
+		'actor_ttl',
+		'nodeinfo_ttl',
+		'nodeinfo_negative_ttl',
+		'objects_ttl',
+		'negative_ttl'
+	}
+
+	deliverykeys = {
+		'delivery_workers',
+		'delivery_queue',
+		'retry_attempts',
+		'retry_delay',
+		'retry_max_delay',
+		'host_limit',
+		'host_rate',
+		'sign_workers',
+		'breaker_threshold',
+		'breaker_cooldown',
+		'slow_latency',
+		'slow_limit'
+	}
+
+	inboxkeys = {
+		'verify_workers',
+		'inbox_max_size',
+		'inbox_mode',
+		'inbox_queue',
+		'inbox_workers',
+		'inbox_retry_after',
+		'inbox_rate',
+		'inbox_burst',
+		'inbox_delete_rate',
+		'inbox_delete_burst'
+	}
+
+	httpkeys = {
+		'http_limit',
+		'http_host_limit',
+		'http_keepalive',
+		'delivery_connect_timeout',
+		'delivery_read_timeout',
+		'delivery_timeout',
+		'fetch_connect_timeout',
+		'fetch_read_timeout',
+		'fetch_timeout'
 	}
 
 
@@ -74,21 +126,65 @@ class RelayConfig(DotDict):
 
 		self._isdocker = is_docker
 		self._path = Path(path).expanduser()
+		self._policy = None
 
 		super().__init__({
 			'db': str(self._path.parent.joinpath(f'{self._path.stem}.jsonld')),
+			'db_backend': 'json',
+			'db_save_interval': 5,
 			'listen': '0.0.0.0',
 			'port': 8080,
 			'note': 'Make a note about your instance here.',
 			'push_limit': 512,
+			'push_limit_min': 32,
+			'push_limit_max': 1024,
+			'push_latency': 5,
 			'host': 'relay.example.com',
 			'blocked_software': [],
 			'blocked_instances': [],
 			'whitelist': [],
 			'whitelist_enabled': False,
 			'json': 1024,
-			'objects': 1024,
-			'digests': 1024
+			'objects': 1000000,
+			'actors': 1024,
+			'nodeinfo': 4096,
+			'key_ttl': 86400,
+			'actor_ttl': 3600,
+			'nodeinfo_ttl': 604800,
+			'nodeinfo_negative_ttl': 86400,
+			'objects_ttl': 172800,
+			'negative_ttl': 60,
+			'http_limit': 1024,
+			'http_host_limit': 16,
+			'http_keepalive': 60,
+			'delivery_workers': 1024,
+			'delivery_queue': 100000,
+			'retry_attempts': 8,
+			'retry_delay': 30,
+			'retry_max_delay': 3600,
+			'host_limit': 8,
+			'host_rate': 0,
+			'sign_workers': 0,
+			'breaker_threshold': 5,
+			'breaker_cooldown': 300,
+			'slow_latency': 10,
+			'slow_limit': 16,
+			'delivery_connect_timeout': 10,
+			'delivery_read_timeout': 30,
+			'delivery_timeout': 60,
+			'fetch_connect_timeout': 5,
+			'fetch_read_timeout': 10,
+			'fetch_timeout': 20,
+			'verify_workers': 0,
+			'inbox_max_size': 1048576,
+			'inbox_mode': 'sync',
+			'inbox_queue': 10000,
+			'inbox_workers': 64,
+			'inbox_retry_after': 30,
+			'inbox_rate': 0,
+			'inbox_burst': 100,
+			'inbox_delete_rate': 0,
+			'inbox_delete_burst': 100
 		})
 
 
@@ -98,10 +194,27 @@ class RelayConfig(DotDict):
 
 		if key in ['blocked_instances', 'blocked_software', 'whitelist']:
 			assert isinstance(value, (list, set, tuple))
-
-		elif key in ['port', 'json', 'objects', 'digests']:
+			self._policy = None
+
+		elif key in ['port', 'push_limit', 'push_limit_min', 'push_limit_max', 'json', 'objects', 'actors', 'nodeinfo', 'key_ttl', 'actor_ttl',
+			'nodeinfo_ttl', 'nodeinfo_negative_ttl', 'objects_ttl', 'negative_ttl', 'http_limit', 'http_host_limit', 'http_keepalive',
+			'delivery_workers', 'delivery_queue', 'retry_attempts', 'retry_delay', 'retry_max_delay',
+			'host_limit', 'sign_workers', 'breaker_threshold', 'breaker_cooldown', 'slow_limit',
+			'verify_workers', 'inbox_max_size', 'inbox_queue', 'inbox_workers', 'inbox_retry_after',
+			'inbox_burst', 'inbox_delete_burst']:
 			assert isinstance(value, (int))
 
+		elif key == 'db_backend':
+			assert value in ['json', 'sqlite']
+
+		elif key == 'inbox_mode':
+			assert value in ['sync', 'async']
+
+		elif key in ['db_save_interval', 'host_rate', 'push_latency', 'slow_latency', 'delivery_connect_timeout', 'delivery_read_timeout',
+			'delivery_timeout', 'fetch_connect_timeout', 'fetch_read_timeout', 'fetch_timeout', 'inbox_rate',
+			'inbox_delete_rate']:
+			assert isinstance(value, (int, float))
+
 		elif key == 'whitelist_enabled':
 			assert isinstance(value, bool)
 
@@ -113,11 +226,41 @@ class RelayConfig(DotDict):
 		return Path(self['db']).expanduser().resolve()
 
 
+	@property
+	def sqlite_db(self):
+		return self.db.with_suffix('.sqlite3')
+
+
+	@property
+	def spool(self):
+		return self.db.parent.joinpath(f'{self.db.stem}.spool.sqlite3')
+
+
+	@property
+	def nodeinfo_cache(self):
+		return self.db.parent.joinpath(f'{self.db.stem}.nodeinfo.json')
+
+
+	@property
+	def objects_cache(self):
+		return self.db.parent.joinpath(f'{self.db.stem}.objects')
+
+
 	@property
 	def path(self):
 		return self._path
 
 
+	@property
+	def policy(self):
+		## compiled from the block lists and whitelist the first time it's needed after
+		## one of them changes
+		if not self._policy:
+			self._policy = DomainPolicy(self)
+
+		return self._policy
+
+
 	@property
 	def actor(self):
 		return f'https://{self.host}/actor'
@@ -141,6 +284,7 @@ class RelayConfig(DotDict):
 			return False
 
 		self.blocked_instances.append(instance)
+		self._policy = None
 		return True
 
 
@@ -150,6 +294,7 @@ class RelayConfig(DotDict):
 
 		try:
 			self.blocked_instances.remove(instance)
+			self._policy = None
 			return True
 
 		except:
@@ -161,12 +306,14 @@ class RelayConfig(DotDict):
 			return False
 
 		self.blocked_software.append(software)
+		self._policy = None
 		return True
 
 
 	def unban_software(self, software):
 		try:
 			self.blocked_software.remove(software)
+			self._policy = None
 			return True
 
 		except:
@@ -181,6 +328,7 @@ class RelayConfig(DotDict):
 			return False
 
 		self.whitelist.append(instance)
+		self._policy = None
 		return True
 
 
@@ -190,6 +338,7 @@ class RelayConfig(DotDict):
 
 		try:
 			self.whitelist.remove(instance)
+			self._policy = None
 			return True
 
 		except:
@@ -200,21 +349,21 @@ class RelayConfig(DotDict):
 		if instance.startswith('http'):
 			instance = urlparse(instance).hostname
 
-		return instance in self.blocked_instances
+		return bool(instance) and instance in self.policy.blocked_instances
 
 
 	def is_banned_software(self, software):
 		if not software:
 			return False
 
-		return software.lower() in self.blocked_software
+		return software.lower() in self.policy.blocked_software
 
 
 	def is_whitelisted(self, instance):
 		if instance.startswith('http'):
 			instance = urlparse(instance).hostname
 
-		return instance in self.whitelist
+		return bool(instance) and instance in self.policy.whitelist
 
 
 	def load(self):
@@ -237,7 +386,7 @@ class RelayConfig(DotDict):
 			return False
 
 		for key, value in config.items():
-			if key in ['ap', 'cache']:
+			if key in ['ap', 'cache', 'http', 'delivery', 'inbox']:
 				for k, v in value.items():
 					if k not in self:
 						continue
@@ -258,12 +407,20 @@ class RelayConfig(DotDict):
 	def save(self):
 		config = {
 			'db': self['db'],
+			'db_backend': self.db_backend,
+			'db_save_interval': self.db_save_interval,
 			'listen': self.listen,
 			'port': self.port,
 			'note': self.note,
 			'push_limit': self.push_limit,
+			'push_limit_min': self.push_limit_min,
+			'push_limit_max': self.push_limit_max,
+			'push_latency': self.push_latency,
 			'ap': {key: self[key] for key in self.apkeys},
-			'cache': {key: self[key] for key in self.cachekeys}
+			'cache': {key: self[key] for key in self.cachekeys | self.cachettlkeys},
+			'http': {key: self[key] for key in self.httpkeys},
+			'delivery': {key: self[key] for key in self.deliverykeys},
+			'inbox': {key: self[key] for key in self.inboxkeys}
 		}
 
 		with open(self._path, 'w') as fd:
@@ -1,10 +1,16 @@
+import asyncio
 import json
 import logging
+import sqlite3
+import time
 import traceback
 
 from Crypto.PublicKey import RSA
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
+from .misc import dump_json
+
 
 class RelayDatabase:
 	def __init__(self, config):
@@ -12,6 +18,17 @@ class RelayDatabase:
 		self.data = None
 		self.PRIVKEY = None
 
+		## hostname -> inbox and the set of all inboxes, kept up to date by add_inbox and
+		## del_inbox so lookups don't have to go through the whole list
+		self.hostname_index = {}
+		self.inbox_set = set()
+		self._hostnames = None
+
+		## changes that haven't been written yet. writes go through a single thread so
+		## they can't overlap
+		self.dirty = False
+		self.executor = ThreadPoolExecutor(max_workers=1)
+
 
 	@property
 	def PUBKEY(self):
@@ -34,7 +51,10 @@ class RelayDatabase:
 
 	@property
 	def hostnames(self):
-		return [urlparse(inbox).hostname for inbox in self.inboxes]
+		if self._hostnames is None:
+			self._hostnames = list(self.hostname_index)
+
+		return self._hostnames
 
 
 	@property
@@ -47,33 +67,54 @@ class RelayDatabase:
 		self.data['private-key'] = self.PRIVKEY.exportKey('PEM').decode('utf-8')
 
 
-	def load(self):
-		new_db = True
+	def build_index(self):
+		self.hostname_index = {}
 
-		try:
-			with self.config.db.open() as fd:
-				self.data = json.load(fd)
+		## only the first inbox of each host is kept, like add_inbox does
+		for inbox in self.inboxes:
+			self.hostname_index.setdefault(urlparse(inbox).hostname, inbox)
 
-			key = self.data.pop('actorKeys', None)
+		self.data['relay-list'] = list(self.hostname_index.values())
+		self.inbox_set = set(self.inboxes)
+		self._hostnames = None
 
-			if key:
-				self.data['private-key'] = key.get('privateKey')
 
-			self.data.pop('actors', None)
-			new_db = False
+	def read(self):
+		## returns the contents of the database or None if there isn't one yet
+		try:
+			with self.config.db.open() as fd:
+				data = json.load(fd)
 
 		except FileNotFoundError:
-			pass
+			return None
 
 		except json.decoder.JSONDecodeError as e:
 			if self.config.db.stat().st_size > 0:
 				raise e from None
 
+			return None
+
+		key = data.pop('actorKeys', None)
+
+		if key:
+			data['private-key'] = key.get('privateKey')
+
+		data.pop('actors', None)
+		return data
+
+
+	def load(self):
+		self.data = self.read()
+		new_db = self.data is None
+
 		if not self.data:
 			logging.info('No database was found. Making a new one.')
 			self.data = {}
 
-		for inbox in self.inboxes:
+		self.data.setdefault('relay-list', [])
+		self.build_index()
+
+		for inbox in list(self.inboxes):
 			if self.config.is_banned(inbox) or (self.config.whitelist_enabled and not self.config.is_whitelisted(inbox)):
 				self.del_inbox(inbox)
 
@@ -89,22 +130,43 @@ class RelayDatabase:
 
 
 	def save(self):
-		with self.config.db.open('w') as fd:
-			data = {
-				'relay-list': self.inboxes,
-				'private-key': self.privkey
-			}
+		self.dirty = False
+		dump_json(self.config.db, self.export(), indent=4)
+
+
+	def save_later(self):
+		## saves from the event loop are left to flush so a burst of changes only causes
+		## one write
+		self.dirty = True
+
+
+	def export(self):
+		return {
+			'relay-list': list(self.inboxes),
+			'private-key': self.privkey
+		}
+
 
-			json.dump(data, fd, indent=4)
+	async def flush(self):
+		if not self.dirty:
+			return
+
+		self.dirty = False
+		data = self.export()
+
+		try:
+			await asyncio.get_running_loop().run_in_executor(self.executor, dump_json, self.config.db, data, 4)
+
+		except OSError as e:
+			self.dirty = True
+			logging.warning(f'Failed to save database: {e}')
 
 
 	def get_inbox(self, domain):
 		if domain.startswith('http'):
 			domain = urlparse(domain).hostname
 
-		for inbox in self.inboxes:
-			if domain == urlparse(inbox).hostname:
-				return inbox
+		return self.hostname_index.get(domain)
 
 
 	def add_inbox(self, inbox):
@@ -112,6 +174,9 @@ class RelayDatabase:
 		assert not self.get_inbox(inbox)
 
 		self.data['relay-list'].append(inbox)
+		self.hostname_index[urlparse(inbox).hostname] = inbox
+		self.inbox_set.add(inbox)
+		self._hostnames = None
 
 
 	def del_inbox(self, inbox_url):
@@ -121,3 +186,106 @@ class RelayDatabase:
 			raise KeyError(inbox_url)
 
 		self.data['relay-list'].remove(inbox)
+		del self.hostname_index[urlparse(inbox).hostname]
+		self.inbox_set.discard(inbox)
+		self._hostnames = None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inboxes (
+	inbox TEXT PRIMARY KEY,
+	hostname TEXT NOT NULL UNIQUE,
+	software TEXT,
+	followed_at REAL,
+	last_success REAL
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+	key TEXT PRIMARY KEY,
+	value TEXT
+);
+"""
+
+
+class SqliteRelayDatabase(RelayDatabase):
+	## stores inboxes as rows, so following and unfollowing only write one row instead of
+	## the whole database
+
+	def __init__(self, config):
+		super().__init__(config)
+		self.path = config.sqlite_db
+		self.conn = None
+
+
+	def read(self):
+		self.conn = sqlite3.connect(str(self.path), isolation_level=None)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.executescript(SCHEMA)
+
+		key = self.conn.execute('SELECT value FROM settings WHERE key = ?', ('private-key',)).fetchone()
+
+		## the key is saved in the same transaction as the imported inboxes, so a database
+		## without one hasn't been set up yet even if the file exists
+		if not key:
+			return self.migrate()
+
+		return {
+			'relay-list': [row[0] for row in self.conn.execute('SELECT inbox FROM inboxes ORDER BY rowid')],
+			'private-key': key[0]
+		}
+
+
+	def migrate(self):
+		data = super().read()
+
+		if not data:
+			return data
+
+		logging.info(f'Importing {self.config.db} into {self.path}')
+
+		with self.conn:
+			self.conn.execute('BEGIN')
+			self.conn.executemany(
+				'INSERT OR IGNORE INTO inboxes (inbox, hostname) VALUES (?, ?)',
+				[(inbox, urlparse(inbox).hostname) for inbox in data.get('relay-list', [])]
+			)
+
+			if data.get('private-key'):
+				self.conn.execute(
+					'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+					('private-key', data['private-key'])
+				)
+
+		return data
+
+
+	def save(self):
+		## inboxes are written as they are added or removed, so only the key is left
+		self.dirty = False
+		self.conn.execute(
+			'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+			('private-key', self.privkey)
+		)
+
+
+	def add_inbox(self, inbox):
+		super().add_inbox(inbox)
+
+		self.conn.execute(
+			'INSERT INTO inboxes (inbox, hostname, followed_at) VALUES (?, ?, ?)',
+			(inbox, urlparse(inbox).hostname, time.time())
+		)
+
+
+	def del_inbox(self, inbox_url):
+		inbox = self.get_inbox(inbox_url)
+		super().del_inbox(inbox_url)
+
+		self.conn.execute('DELETE FROM inboxes WHERE inbox = ?', (inbox,))
+
+
+	async def flush(self):
+		## writing the key is a single row, so it isn't worth a thread
+		if self.dirty:
+			self.save()
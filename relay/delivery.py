@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import random
+import time
+import traceback
+
+from collections import deque
+from urllib.parse import urlparse
+
+from . import app, misc
+from .scheduler import Waiters
+
+
+## how often to check the spool for deliveries that are due to be retried
+SPOOL_INTERVAL = 5
+
+## number of deliveries to load from the spool at once
+SPOOL_BATCH = 500
+
+
+def is_transient(status):
+	## no status means a connection error or timeout
+	return not status or status >= 500 or status in [408, 429]
+
+
+class DeliveryQueue:
+	def __init__(self, spool):
+		config = app['config']
+
+		self.maxsize = config.delivery_queue
+		self.workers = config.delivery_workers
+		self.retry_attempts = config.retry_attempts
+		self.retry_delay = config.retry_delay
+		self.retry_max_delay = config.retry_max_delay
+		self.spool = spool
+		self.spooled = 0
+		self.size = 0
+		self.tasks = []
+
+		## queued jobs for each host and the order hosts take turns in
+		self.hosts = {}
+		self.ring = deque()
+
+		## ids of jobs that are in the queue or being delivered
+		self.pending = set()
+
+		## idle workers wait here for new jobs or free scheduler slots
+		self.waiters = Waiters()
+		self.scheduler = app['scheduler']
+		self.scheduler.listeners.append(self.handle_release)
+		self.breaker = app['breaker']
+
+
+	@property
+	def depth(self):
+		return self.size
+
+
+	@property
+	def stats(self):
+		return {
+			'depth': self.depth,
+			'size': self.maxsize,
+			'hosts': len(self.hosts),
+			'workers': self.workers,
+			'spooled': self.spooled
+		}
+
+
+	def start(self):
+		for _ in range(self.workers):
+			self.tasks.append(asyncio.ensure_future(self.handle_worker()))
+
+		self.tasks.append(asyncio.ensure_future(self.handle_spool()))
+
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+
+	def enqueue(self, job_id, inbox, payload, attempts=0):
+		if job_id in self.pending:
+			return True
+
+		if self.size >= self.maxsize:
+			return False
+
+		host = urlparse(inbox).hostname
+
+		if host not in self.hosts:
+			self.hosts[host] = deque()
+			self.ring.append(host)
+
+		self.hosts[host].append((job_id, inbox, payload, attempts))
+		self.pending.add(job_id)
+		self.size += 1
+		self.waiters.wake(1)
+		return True
+
+
+	def pop_job(self, host):
+		jobs = self.hosts[host]
+		job = jobs.popleft()
+		self.size -= 1
+
+		## the host was just moved to the back of the line by get_job
+		if not jobs:
+			del self.hosts[host]
+			self.ring.pop()
+
+		return job
+
+
+	def get_job(self):
+		## take the next job from the first host in turn that has a free slot and move
+		## that host to the back of the line. jobs for hosts with an open circuit are
+		## returned without a slot so they can be put back in the spool
+		delay = None
+
+		for _ in range(len(self.ring)):
+			host = self.ring[0]
+			self.ring.rotate(-1)
+
+			if not self.breaker.allow(host):
+				return host, self.pop_job(host), False, None
+
+			if self.scheduler.try_acquire(host):
+				return host, self.pop_job(host), True, None
+
+			host_delay = self.scheduler.get_delay(host)
+
+			if host_delay is not None and (delay is None or host_delay < delay):
+				delay = host_delay
+
+		return None, None, False, delay
+
+
+	async def get(self):
+		while True:
+			host, job, acquired, delay = self.get_job()
+
+			if job:
+				return host, job, acquired
+
+			await self.waiters.wait(delay)
+
+
+	def get_retry_time(self, attempts):
+		delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+		return time.time() + random.uniform(delay / 2, delay)
+
+
+	async def push(self, inboxes, payload):
+		jobs = await self.spool.add(inboxes, payload)
+
+		## jobs that don't fit in the queue stay in the spool until there is room
+		for job_id, inbox in jobs:
+			if not self.enqueue(job_id, inbox, payload):
+				break
+
+
+	async def handle_result(self, job_id, inbox, payload, attempts, status, wait=0):
+		if not is_transient(status):
+			await self.spool.remove(job_id)
+			return
+
+		attempts += 1
+
+		if attempts >= self.retry_attempts:
+			logging.verbose(f'Giving up on delivering {payload.type} to {inbox} after {attempts} attempts')
+			await self.spool.remove(job_id)
+			return
+
+		next_attempt = max(self.get_retry_time(attempts), time.time() + wait)
+		await self.spool.reschedule(job_id, attempts, next_attempt)
+
+
+	def handle_release(self, host):
+		self.waiters.wake(1)
+
+
+	async def handle_worker(self):
+		while True:
+			host, (job_id, inbox, payload, attempts), acquired = await self.get()
+
+			try:
+				if acquired:
+					self.breaker.start(host)
+
+					## free the slot before waiting on the spool so other requests can use it
+					try:
+						status = await misc.request(inbox, payload, limit=False)
+
+					finally:
+						self.scheduler.release(host)
+
+				## the host has been failing, so count this as a failed attempt without sending
+				else:
+					status = None
+
+				await self.handle_result(job_id, inbox, payload, attempts, status, self.breaker.get_wait(host))
+
+			except Exception:
+				traceback.print_exc()
+
+			finally:
+				self.pending.discard(job_id)
+
+
+	async def handle_spool(self):
+		while True:
+			try:
+				after = None
+
+				## jobs that are already queued are skipped by enqueue
+				while self.size < self.maxsize:
+					jobs, after = await self.spool.due(SPOOL_BATCH, after)
+
+					for job in jobs:
+						if not self.enqueue(*job):
+							break
+
+					if not after:
+						break
+
+				self.spooled = await self.spool.count()
+
+			except Exception:
+				traceback.print_exc()
+
+			await asyncio.sleep(SPOOL_INTERVAL)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import traceback
+
+from aiohttp.web import HTTPException
+
+from . import app
+
+
+class InboxQueue:
+	def __init__(self, handler):
+		config = app['config']
+
+		self.handler = handler
+		self.maxsize = config.inbox_queue
+		self.workers = config.inbox_workers
+		self.queue = asyncio.Queue(self.maxsize)
+		self.tasks = []
+
+		## messages that were turned away because the queue was full
+		self.rejected = 0
+
+
+	@property
+	def stats(self):
+		return {
+			'depth': self.queue.qsize(),
+			'size': self.maxsize,
+			'workers': self.workers,
+			'rejected': self.rejected
+		}
+
+
+	def start(self):
+		for _ in range(self.workers):
+			self.tasks.append(asyncio.ensure_future(self.handle_worker()))
+
+
+	async def stop(self):
+		for task in self.tasks:
+			task.cancel()
+
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+
+
+	def push(self, request, data):
+		try:
+			self.queue.put_nowait((request, data))
+			return True
+
+		except asyncio.QueueFull:
+			self.rejected += 1
+			return False
+
+
+	async def handle_worker(self):
+		while True:
+			request, data = await self.queue.get()
+
+			try:
+				await self.handler(request, data)
+
+			## the sender already got its response, so there is nobody to tell
+			except HTTPException as e:
+				logging.verbose(f'Dropped {data.get("type")} from {data.get("actor")}: {e.text}')
+
+			except Exception:
+				traceback.print_exc()
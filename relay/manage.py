@@ -5,13 +5,28 @@ import json
 import logging
 import os
 import platform
+import signal
+import traceback
 
 from aiohttp.web import AppRunner, TCPSite
-from cachetools import LRUCache
+from cachetools import LRUCache, TTLCache
 
 from . import app, misc, views, __version__
+from .breaker import CircuitBreaker
+from .cache import ObjectFilter, RefreshCache
 from .config import DotDict, RelayConfig, relay_software_names
-from .database import RelayDatabase
+from .database import RelayDatabase, SqliteRelayDatabase
+from .delivery import DeliveryQueue
+from .inbox import InboxQueue
+from .policy import DomainMatcher
+from .ratelimit import InboxLimiter
+from .scheduler import HostScheduler
+from .signatures import Signer, Verifier
+from .spool import DeliverySpool
+
+
+## how often to write persistent caches to disk
+CACHE_SAVE_INTERVAL = 300
 
 
 @click.group('cli', context_settings={'show_default': True}, invoke_without_command=True)
@@ -25,14 +40,30 @@ def cli(ctx, config):
 	if not app['config'].load():
 		app['config'].save()
 
-	app['database'] = RelayDatabase(app['config'])
+	if app['config'].db_backend == 'sqlite':
+		app['database'] = SqliteRelayDatabase(app['config'])
+
+	else:
+		app['database'] = RelayDatabase(app['config'])
+
 	app['database'].load()
 
 	app['cache'] = DotDict()
-	app['semaphore'] = asyncio.Semaphore(app['config']['push_limit'])
-
-	for key in app['config'].cachekeys:
-		app['cache'][key] = LRUCache(app['config'][key])
+	app['breaker'] = CircuitBreaker(app['config'].breaker_threshold, app['config'].breaker_cooldown)
+	app['signer'] = Signer(app['database'].PRIVKEY, app['config'].sign_workers)
+	app['verifier'] = Verifier(app['config'].verify_workers)
+	app['scheduler'] = HostScheduler(app['config'])
+	app['limiter'] = InboxLimiter(app['config'])
+
+	app['cache'].json = LRUCache(app['config'].json)
+	app['cache'].objects = ObjectFilter(app['config'].objects, app['config'].objects_ttl, app['config'].objects_cache)
+	app['cache'].actors = RefreshCache(app['config'].actors, app['config'].actor_ttl, app['config'].negative_ttl)
+	app['cache'].pubkeys = TTLCache(app['config'].actors, app['config'].key_ttl)
+	app['cache'].nodeinfo = RefreshCache(app['config'].nodeinfo, app['config'].nodeinfo_ttl,
+		app['config'].negative_ttl, app['config'].nodeinfo_cache, app['config'].nodeinfo_negative_ttl)
+
+	app['cache'].nodeinfo.load()
+	app['cache'].objects.load()
 
 	if not ctx.invoked_subcommand:
 		if app['config'].host.endswith('example.com'):
@@ -174,13 +205,23 @@ def cli_instance_ban(target):
 
 	config = app['config']
 	database = app['database']
-	inbox = database.get_inbox(target)
 
 	if config.ban_instance(target):
 		config.save()
 
-		if inbox:
+		## a wildcard rule can match any number of subscribed inboxes
+		if target.startswith('*.'):
+			rule = DomainMatcher([target])
+			inboxes = [inbox for hostname, inbox in database.hostname_index.items() if hostname in rule]
+
+		else:
+			inboxes = [inbox for inbox in [database.get_inbox(target)] if inbox]
+
+		for inbox in inboxes:
 			database.del_inbox(inbox)
+			click.echo(f'Removed inbox: {inbox}')
+
+		if inboxes:
 			database.save()
 
 		click.echo(f'Banned instance: {target}')
@@ -239,7 +280,7 @@ def cli_software_ban(name, fetch_nodeinfo):
 		return click.echo('Banned all relay software')
 
 	if fetch_nodeinfo:
-		software = run_in_loop(fetch_nodeinfo, name)
+		software = run_in_loop(misc.fetch_nodeinfo, name)
 
 		if not software:
 			click.echo(f'Failed to fetch software name from domain: {name}')
@@ -271,7 +312,7 @@ def cli_software_unban(name, fetch_nodeinfo):
 		return click.echo('Unbanned all relay software')
 
 	if fetch_nodeinfo:
-		software = run_in_loop(fetch_nodeinfo, name)
+		software = run_in_loop(misc.fetch_nodeinfo, name)
 
 		if not software:
 			click.echo(f'Failed to fetch software name from domain: {name}')
@@ -401,19 +442,86 @@ def relay_run():
 
 	loop = asyncio.new_event_loop()
 	asyncio.set_event_loop(loop)
+
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		try:
+			loop.add_signal_handler(sig, loop.stop)
+
+		## not supported on windows
+		except NotImplementedError:
+			pass
+
 	asyncio.ensure_future(handle_start_webserver(), loop=loop)
-	loop.run_forever()
+
+	try:
+		loop.run_forever()
+
+	except KeyboardInterrupt:
+		pass
+
+	## a second signal stops the relay right away instead of interrupting the shutdown
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		try:
+			loop.remove_signal_handler(sig)
+
+		except NotImplementedError:
+			pass
+
+	loop.run_until_complete(handle_stop_webserver())
+	loop.close()
 
 
 def run_in_loop(func, *args, **kwargs):
 	loop = asyncio.new_event_loop()
-	return loop.run_until_complete(func(*args, **kwargs))
+	return loop.run_until_complete(handle_run_command(func, *args, **kwargs))
+
+
+async def handle_run_command(func, *args, **kwargs):
+	app['session'] = misc.create_session()
+
+	try:
+		return await func(*args, **kwargs)
+
+	finally:
+		await app['session'].close()
+
+
+async def handle_save_cache():
+	while True:
+		await asyncio.sleep(CACHE_SAVE_INTERVAL)
+		await app['cache'].nodeinfo.save()
+		await app['cache'].objects.save()
+
+
+async def handle_save_database():
+	while True:
+		await asyncio.sleep(app['config'].db_save_interval)
+
+		try:
+			await app['database'].flush()
+
+		except Exception:
+			traceback.print_exc()
 
 
 async def handle_start_webserver():
 	config = app['config']
 	runner = AppRunner(app, access_log_format='%{X-Forwarded-For}i "%r" %s %b "%{Referer}i" "%{User-Agent}i"')
 
+	app['runner'] = runner
+	app['session'] = misc.create_session()
+	app['delivery'] = DeliveryQueue(DeliverySpool(config.spool))
+
+	if config.inbox_mode == 'async':
+		app['inbox'] = InboxQueue(views.process_inbox)
+		app['inbox'].start()
+
+	await app['delivery'].spool.open()
+	app['delivery'].start()
+	app['signer'].start()
+	app['cache_task'] = asyncio.ensure_future(handle_save_cache())
+	app['database_task'] = asyncio.ensure_future(handle_save_database())
+
 	logging.info(f'Starting webserver at {config.host} ({config.listen}:{config.port})')
 	await runner.setup()
 
@@ -421,6 +529,29 @@ async def handle_start_webserver():
 	await site.start()
 
 
+async def handle_stop_webserver():
+	logging.info('Stopping webserver')
+
+	await app['runner'].cleanup()
+
+	if 'inbox' in app:
+		await app['inbox'].stop()
+
+	await app['delivery'].stop()
+	await app['delivery'].spool.close()
+
+	app['cache_task'].cancel()
+	await app['cache'].nodeinfo.save()
+	await app['cache'].objects.save()
+
+	app['database_task'].cancel()
+	await app['database'].flush()
+
+	app['signer'].stop()
+	app['verifier'].stop()
+	await app['session'].close()
+
+
 def main():
 	cli(prog_name='relay')
 
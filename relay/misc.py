@@ -2,22 +2,35 @@ import asyncio
 import base64
 import json
 import logging
+import os
 import socket
+import ssl
+import time
 import traceback
 
 from Crypto.Hash import SHA, SHA256, SHA512
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
-from aiohttp import ClientSession
+from aiohttp import ClientConnectionError, ClientConnectorError, ClientSession, ClientTimeout, TCPConnector
 from datetime import datetime
 from json.decoder import JSONDecodeError
-from urllib.parse import urlparse
+from pathlib import Path
+from urllib.parse import urldefrag, urlparse
 from uuid import uuid4
 
 from . import app
 from .http_debug import http_debug
 
 
+## how much of a delivery response to read. the rest is dropped along with the connection
+DELIVERY_READ_LIMIT = 64 * 1024
+
+## minimum number of seconds between fetches of a key after failed signature checks
+KEY_REFETCH_DELAY = 60
+
+## get requests in progress by url
+INFLIGHT = {}
+
 HASHES = {
 	'sha1': SHA,
 	'sha256': SHA256,
@@ -25,6 +38,20 @@ HASHES = {
 }
 
 
+class Payload:
+	## a message encoded once and shared by every delivery it is sent in
+
+	def __init__(self, body, type=None):
+		self.body = body
+		self.type = type
+		self.digest = base64.b64encode(SHA256.new(body).digest()).decode('utf-8')
+
+
+	@classmethod
+	def new(cls, message):
+		return cls(json.dumps(message).encode('utf-8'), message.get('type'))
+
+
 def build_signing_string(headers, used_headers):
 	return '\n'.join(map(lambda x: ': '.join([x.lower(), headers[x]]), used_headers))
 
@@ -41,20 +68,19 @@ def check_open_port(host, port):
 			return False
 
 
-def create_signature_header(headers):
-	headers = {k.lower(): v for k, v in headers.items()}
-	used_headers = headers.keys()
-	sigstring = build_signing_string(headers, used_headers)
+def create_session():
+	config = app['config']
 
-	sig = {
-		'keyId': app['config'].keyid,
-		'algorithm': 'rsa-sha256',
-		'headers': ' '.join(used_headers),
-		'signature': sign_signing_string(sigstring, app['database'].PRIVKEY)
-	}
+	## Share one ssl context between all connections so TLS sessions can be reused
+	connector = TCPConnector(
+		limit = config.http_limit,
+		limit_per_host = config.http_host_limit,
+		keepalive_timeout = config.http_keepalive,
+		ssl = ssl.create_default_context(),
+		enable_cleanup_closed = True
+	)
 
-	chunks = ['{}="{}"'.format(k, v) for k, v in sig.items()]
-	return ','.join(chunks)
+	return ClientSession(connector=connector, trace_configs=http_debug())
 
 
 def distill_object_id(activity):
@@ -69,32 +95,49 @@ def distill_object_id(activity):
 
 def distill_inboxes(actor, object_id):
 	database = app['database']
-	origin_hostname = urlparse(object_id).hostname
 	actor_inbox = get_actor_inbox(actor)
-	targets = []
 
-	for inbox in database.inboxes:
-		if inbox != actor_inbox or urlparse(inbox).hostname != origin_hostname:
-			targets.append(inbox)
+	## don't send an object back to the inbox of the instance it came from
+	if actor_inbox in database.inbox_set and urlparse(actor_inbox).hostname == urlparse(object_id).hostname:
+		return database.inbox_set - {actor_inbox}
 
-	return targets
+	return set(database.inbox_set)
 
 
-def generate_body_digest(body):
-	bodyhash = app['cache'].digests.get(body)
+def dump_json(path, data, indent=None):
+	write_file(path, json.dumps(data, indent=indent).encode('utf-8'))
 
-	if bodyhash:
-		return bodyhash
 
-	h = SHA256.new(body.encode('utf-8'))
-	bodyhash = base64.b64encode(h.digest()).decode('utf-8')
-	app['cache'].digests[body] = bodyhash
+def get_actor_inbox(actor):
+	return actor.get('endpoints', {}).get('sharedInbox', actor['inbox'])
 
-	return bodyhash
 
+def get_timeout(delivery):
+	config = app['config']
 
-def get_actor_inbox(actor):
-	return actor.get('endpoints', {}).get('sharedInbox', actor['inbox'])
+	if delivery:
+		return ClientTimeout(
+			total = config.delivery_timeout,
+			connect = config.delivery_connect_timeout,
+			sock_read = config.delivery_read_timeout
+		)
+
+	return ClientTimeout(
+		total = config.fetch_timeout,
+		connect = config.fetch_connect_timeout,
+		sock_read = config.fetch_read_timeout
+	)
+
+
+def parse_digest(header):
+	## returns a new hash object for the first supported algorithm in a digest header along
+	## with the expected value, or None if none of them are supported
+	for item in header.split(','):
+		algorithm, _, value = item.strip().partition('=')
+		hash = HASHES.get(algorithm.lower().replace('-', ''))
+
+		if hash and value:
+			return hash.new(), value
 
 
 def sign_signing_string(sigstring, key):
@@ -120,26 +163,112 @@ def split_signature(sig):
 	return default
 
 
-async def fetch_actor_key(actor):
-	actor_data = await request(actor)
+def verify_signing_string(sigstring, sigdata, verifier, algorithm):
+	sign_alg, _, hash_alg = algorithm.partition('-')
+	logging.debug(f'sign alg: {sign_alg}, hash alg: {hash_alg}')
+
+	h = HASHES[hash_alg].new()
+	h.update(sigstring.encode('ascii'))
+
+	return verifier.verify(h, sigdata)
+
+
+def write_file(path, data):
+	## write to a temporary file first so a crash can't leave a truncated file behind
+	path = Path(path)
+	tmp_path = path.with_name(f'.{path.name}.tmp')
 
-	if not actor_data:
+	with tmp_path.open('wb') as fd:
+		fd.write(data)
+		fd.flush()
+		os.fsync(fd.fileno())
+
+	os.replace(tmp_path, path)
+
+
+async def create_signature_header(headers):
+	headers = {k.lower(): v for k, v in headers.items()}
+	used_headers = headers.keys()
+	sigstring = build_signing_string(headers, used_headers)
+
+	sig = {
+		'keyId': app['config'].keyid,
+		'algorithm': 'rsa-sha256',
+		'headers': ' '.join(used_headers),
+		'signature': await app['signer'].sign(sigstring)
+	}
+
+	chunks = ['{}="{}"'.format(k, v) for k, v in sig.items()]
+	return ','.join(chunks)
+
+
+async def fetch_actor(actor_id, force=False):
+	return await app['cache'].actors.get(actor_id, fetch_actor_uncached, force)
+
+
+async def fetch_actor_uncached(actor_id):
+	return await request(actor_id, cache=False)
+
+
+async def fetch_actor_key(actor, keyid, force=False):
+	cache = app['cache'].pubkeys
+
+	if not force:
+		try:
+			verifier, owner, _ = cache[keyid]
+
+		except KeyError:
+			pass
+
+		else:
+			return verifier if owner == actor else None
+
+	## the key id points to either the actor or a document with just the key
+	key_data = await fetch_actor(urldefrag(keyid).url, force)
+
+	if not key_data:
 		return None
 
 	try:
-		return RSA.importKey(actor_data['publicKey']['publicKeyPem'])
+		key = key_data.get('publicKey', key_data)
+
+		if isinstance(key, list):
+			key = next(item for item in key if item['id'] == keyid)
+
+		owner = key.get('owner', key_data.get('id'))
+
+		if owner != actor:
+			logging.verbose(f'Key {keyid} is owned by {owner} instead of {actor}')
+			return None
+
+		verifier = PKCS1_v1_5.new(RSA.importKey(key['publicKeyPem']))
 
 	except Exception as e:
 		logging.debug(f'Exception occured while fetching actor key: {e}')
+		return None
 
+	cache[keyid] = (verifier, owner, time.monotonic())
+	return verifier
 
-async def fetch_nodeinfo(domain):
+
+async def fetch_nodeinfo(domain, force=False):
+	software = await app['cache'].nodeinfo.get(domain, fetch_nodeinfo_uncached, force)
+
+	if not software:
+		return None
+
+	return software['name']
+
+
+async def fetch_nodeinfo_uncached(domain):
 	nodeinfo_url = None
 
-	wk_nodeinfo = await request(f'https://{domain}/.well-known/nodeinfo', sign_headers=False, activity=False)
+	## the instance not having nodeinfo is returned as False and remembered for longer than
+	## errors, which are returned as None
+	wk_nodeinfo = await request(f'https://{domain}/.well-known/nodeinfo', sign_headers=False, activity=False, cache=False)
 
 	if not wk_nodeinfo:
-		return
+		return wk_nodeinfo
 
 	for link in wk_nodeinfo.get('links', ''):
 		if link['rel'] == 'http://nodeinfo.diaspora.software/ns/schema/2.0':
@@ -147,27 +276,34 @@ async def fetch_nodeinfo(domain):
 			break
 
 	if not nodeinfo_url:
-		return
+		return False
 
-	nodeinfo_data = await request(nodeinfo_url, sign_headers=False, activity=False)
+	nodeinfo_data = await request(nodeinfo_url, sign_headers=False, activity=False, cache=False)
+
+	if not nodeinfo_data:
+		return nodeinfo_data
 
 	try:
-		return nodeinfo_data['software']['name']
+		return {
+			'name': nodeinfo_data['software']['name'],
+			'version': nodeinfo_data['software'].get('version')
+		}
 
-	except KeyError:
+	except (KeyError, TypeError):
 		return False
 
 
 async def follow_remote_actor(actor_uri):
 	config = app['config']
 
-	actor = await request(actor_uri)
-	inbox = get_actor_inbox(actor)
+	actor = await fetch_actor(actor_uri)
 
 	if not actor:
 		logging.error(f'failed to fetch actor at: {actor_uri}')
 		return
 
+	inbox = get_actor_inbox(actor)
+
 	logging.verbose(f'sending follow request: {actor_uri}')
 
 	message = {
@@ -185,7 +321,7 @@ async def follow_remote_actor(actor_uri):
 async def unfollow_remote_actor(actor_uri):
 	config = app['config']
 
-	actor = await request(actor_uri)
+	actor = await fetch_actor(actor_uri)
 
 	if not actor:
 		logging.error(f'failed to fetch actor: {actor_uri}')
@@ -211,15 +347,57 @@ async def unfollow_remote_actor(actor_uri):
 	await request(inbox, message)
 
 
-async def request(uri, data=None, force=False, sign_headers=True, activity=True):
+async def read_body(resp, limit, hash=None):
+	body = bytearray()
+
+	while len(body) < limit:
+		chunk = await resp.content.read(limit - len(body))
+
+		if not chunk:
+			break
+
+		body.extend(chunk)
+
+		if hash:
+			hash.update(chunk)
+
+	return bytes(body)
+
+
+async def request(uri, data=None, force=False, sign_headers=True, activity=True, limit=True, cache=True):
+	if data:
+		return await send_request(uri, data, sign_headers, activity, limit)
+
 	## If a get request and not force, try to use the cache first
-	if not data and not force:
+	if cache and not force:
 		try:
 			return app['cache'].json[uri]
 
 		except KeyError:
 			pass
 
+	## share a get request that is already in progress for the same url
+	try:
+		task = INFLIGHT[uri]
+
+	except KeyError:
+		task = INFLIGHT[uri] = asyncio.ensure_future(send_request(uri, None, sign_headers, activity, limit))
+		task.add_done_callback(lambda _: INFLIGHT.pop(uri, None) if INFLIGHT.get(uri) is task else None)
+
+	## one caller giving up shouldn't cancel the request for the others
+	resp_payload = await asyncio.shield(task)
+
+	if cache and resp_payload:
+		app['cache'].json[uri] = resp_payload
+
+	return resp_payload
+
+
+async def send_request(uri, data, sign_headers, activity, limit):
+	## encode the message here unless the caller already encoded it for sharing between deliveries
+	if isinstance(data, dict):
+		data = Payload.new(data)
+
 	url = urlparse(uri)
 	method = 'POST' if data else 'GET'
 	headers = {'User-Agent': 'ActivityRelay'}
@@ -233,67 +411,120 @@ async def request(uri, data=None, force=False, sign_headers=True, activity=True)
 	elif not data and 'Accept' not in headers:
 		headers['Accept'] = mimetype
 
-	if sign_headers:
-		signing_headers = {
-			'(request-target)': f'{method.lower()} {url.path}',
-			'Date': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'),
-			'Host': url.netloc
-		}
+	acquired = False
+	start = time.monotonic()
 
-		if data:
-			assert isinstance(data, dict)
+	try:
+		if sign_headers:
+			signing_headers = {
+				'(request-target)': f'{method.lower()} {url.path}',
+				'Date': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT'),
+				'Host': url.netloc
+			}
 
-			action = data.get('type')
-			data = json.dumps(data)
-			signing_headers.update({
-				'Digest': f'SHA-256={generate_body_digest(data)}',
-				'Content-Length': str(len(data.encode('utf-8')))
-			})
+			if data:
+				signing_headers.update({
+					'Digest': f'SHA-256={data.digest}',
+					'Content-Length': str(len(data.body))
+				})
 
-		signing_headers['Signature'] = create_signature_header(signing_headers)
+			signing_headers['Signature'] = await create_signature_header(signing_headers)
 
-		del signing_headers['(request-target)']
-		del signing_headers['Host']
+			del signing_headers['(request-target)']
+			del signing_headers['Host']
 
-		headers.update(signing_headers)
+			headers.update(signing_headers)
 
-	try:
-		# json_serializer=DotDict maybe?
-		async with ClientSession(trace_configs=http_debug()) as session, app['semaphore']:
-			async with session.request(method, uri, headers=headers, data=data) as resp:
-				## aiohttp has been known to leak if the response hasn't been read,
-				## so we're just gonna read the request no matter what
+		## wait for a free slot for the host unless the caller already holds one
+		if limit:
+			await app['scheduler'].acquire(url.hostname)
+			acquired = True
+
+		start = time.monotonic()
+
+		async with app['session'].request(method, uri, headers=headers, data=data.body if data else None, timeout=get_timeout(data)) as resp:
+			## aiohttp has been known to leak if the response hasn't been read, so read
+			## the whole response for fetches and up to a limit for deliveries
+			if data:
+				resp_data = await read_body(resp, DELIVERY_READ_LIMIT)
+
+			else:
 				resp_data = await resp.read()
-				resp_payload = json.loads(resp_data.decode('utf-8'))
 
-				if resp.status not in [200, 202]:
-					if not data:
-						logging.verbose(f'Received error when requesting {uri}: {resp.status} {resp_payload}')
-						return
+			latency = time.monotonic() - start
+
+			app['scheduler'].record_latency(url.hostname, latency)
+
+			if resp.status >= 500:
+				app['breaker'].record_failure(url.hostname)
+
+			else:
+				app['breaker'].record_success(url.hostname)
+
+			## deliveries only return the status so the caller can decide whether to retry
+			if data:
+				app['scheduler'].record_success(latency)
 
-					logging.verbose(f'Received error when sending {action} to {uri}: {resp.status} {resp_payload}')
-					return
+				## the response body is only decoded when it gets logged
+				if not 200 <= resp.status < 300 and logging.root.isEnabledFor(logging.VERBOSE):
+					try:
+						resp_payload = json.loads(resp_data)
 
-				logging.debug(f'{uri} >> resp {resp_payload}')
+					except (JSONDecodeError, UnicodeDecodeError):
+						resp_payload = resp_data.decode('utf-8', 'replace')
 
-				app['cache'].json[uri] = resp_payload
-				return resp_payload
+					logging.verbose(f'Received error when sending {data.type} to {uri}: {resp.status} {resp_payload}')
+
+				return resp.status
+
+			## a document that doesn't exist is an answer, unlike errors that might go away
+			if resp.status in [404, 410]:
+				logging.verbose(f'Received error when requesting {uri}: {resp.status}')
+				return False
+
+			resp_payload = json.loads(resp_data.decode('utf-8'))
+
+			if resp.status not in [200, 202]:
+				logging.verbose(f'Received error when requesting {uri}: {resp.status} {resp_payload}')
+				return
+
+			logging.debug(f'{uri} >> resp {resp_payload}')
+			return resp_payload
 
 	except JSONDecodeError:
 		return
 
-	except Exception:
-		traceback.print_exc()
+	## only hosts that have been working count towards lowering the global limit. hosts
+	## that are known to fail and ones that can't be resolved or refuse connections are
+	## usually dead instances and say nothing about how busy the relay is
 
+	except asyncio.TimeoutError:
+		logging.verbose(f'Timed out requesting {uri}')
+		app['scheduler'].record_latency(url.hostname, time.monotonic() - start)
 
-async def validate_signature(actor, http_request):
-	pubkey = await fetch_actor_key(actor)
+		if data and not app['breaker'].is_failing(url.hostname):
+			app['scheduler'].record_failure(url.hostname)
 
-	if not pubkey:
-		return False
+		app['breaker'].record_failure(url.hostname)
+
+	except ClientConnectionError as e:
+		logging.verbose(f'Failed to connect to {uri}: {e!r}')
+
+		if data and not isinstance(e, ClientConnectorError) and not app['breaker'].is_failing(url.hostname):
+			app['scheduler'].record_failure(url.hostname)
 
-	logging.debug(f'actor key: {pubkey}')
+		app['breaker'].record_failure(url.hostname)
 
+	except Exception:
+		traceback.print_exc()
+		app['breaker'].record_failure(url.hostname)
+
+	finally:
+		if acquired:
+			app['scheduler'].release(url.hostname)
+
+
+async def validate_signature(actor, http_request):
 	headers = {key.lower(): value for key, value in http_request.headers.items()}
 	headers['(request-target)'] = ' '.join([http_request.method.lower(), http_request.path])
 
@@ -303,15 +534,27 @@ async def validate_signature(actor, http_request):
 	sigstring = build_signing_string(headers, sig['headers'])
 	logging.debug(f'sigstring: {sigstring}')
 
-	sign_alg, _, hash_alg = sig['algorithm'].partition('-')
-	logging.debug(f'sign alg: {sign_alg}, hash alg: {hash_alg}')
-
 	sigdata = base64.b64decode(sig['signature'])
+	keyid = sig.get('keyId', actor)
 
-	pkcs = PKCS1_v1_5.new(pubkey)
-	h = HASHES[hash_alg].new()
-	h.update(sigstring.encode('ascii'))
-	result = pkcs.verify(h, sigdata)
+	## the key has to be on the actor's instance, or anybody could make the relay fetch any url
+	if urlparse(keyid).hostname != urlparse(actor).hostname:
+		logging.verbose(f'Key {keyid} is not on the same host as {actor}')
+		http_request['validated'] = False
+		return False
+
+	verifier = await fetch_actor_key(actor, keyid)
+	result = bool(verifier) and await app['verifier'].verify(verifier, sig['algorithm'], sigstring, sigdata)
+
+	## the actor might have changed its key, so fetch it again unless it was just fetched. a
+	## key that couldn't be fetched or has the wrong owner isn't fetched again before it expires
+	if not result and verifier:
+		fetched = app['cache'].pubkeys.get(keyid, (None, None, time.monotonic()))[2]
+
+		if time.monotonic() - fetched > KEY_REFETCH_DELAY:
+			logging.verbose(f'Fetching key again after failed signature check: {keyid}')
+			verifier = await fetch_actor_key(actor, keyid, force=True)
+			result = bool(verifier) and await app['verifier'].verify(verifier, sig['algorithm'], sigstring, sigdata)
 
 	http_request['validated'] = result
 
@@ -0,0 +1,57 @@
+## marks the end of a wildcard rule in a suffix trie
+WILDCARD = '*'
+
+
+class DomainMatcher:
+	## matches hostnames against exact names and `*.example.com` rules. wildcard rules are
+	## stored as a trie of labels in reverse order, so a lookup only walks the labels of
+	## the hostname no matter how many rules there are
+
+	def __init__(self, domains):
+		exact = set()
+		self.trie = {}
+
+		for domain in domains:
+			domain = domain.lower().strip('.')
+
+			if not domain.startswith('*.'):
+				exact.add(domain)
+				continue
+
+			node = self.trie
+
+			for label in reversed(domain[2:].split('.')):
+				node = node.setdefault(label, {})
+
+			node[WILDCARD] = True
+
+		self.exact = frozenset(exact)
+
+
+	def __contains__(self, hostname):
+		hostname = hostname.lower()
+
+		if hostname in self.exact:
+			return True
+
+		node = self.trie
+		labels = hostname.split('.')
+
+		## a wildcard only matches subdomains, so the first label is never checked
+		for label in reversed(labels[1:]):
+			node = node.get(label)
+
+			if node is None:
+				return False
+
+			if WILDCARD in node:
+				return True
+
+		return False
+
+
+class DomainPolicy:
+	def __init__(self, config):
+		self.blocked_instances = DomainMatcher(config.blocked_instances)
+		self.whitelist = DomainMatcher(config.whitelist)
+		self.blocked_software = frozenset(software.lower() for software in config.blocked_software)
@@ -11,7 +11,7 @@ async def handle_relay(actor, data, request):
 	object_id = misc.distill_object_id(data)
 
 	if object_id in cache:
-		logging.verbose(f'already relayed {object_id} as {cache[object_id]}')
+		logging.verbose(f'already relayed {object_id}')
 		return
 
 	logging.verbose(f'Relaying post from {actor["id"]}')
@@ -30,10 +30,9 @@ async def handle_relay(actor, data, request):
 	logging.debug(f'>> relay: {message}')
 
 	inboxes = misc.distill_inboxes(actor, object_id)
-	futures = [misc.request(inbox, data=message) for inbox in inboxes]
+	cache.add(object_id)
 
-	asyncio.ensure_future(asyncio.gather(*futures))
-	cache[object_id] = activity_id
+	await app['delivery'].push(inboxes, misc.Payload.new(message))
 
 
 async def handle_forward(actor, data, request):
@@ -49,11 +48,9 @@ async def handle_forward(actor, data, request):
 	logging.debug(f'>> Relay {data}')
 
 	inboxes = misc.distill_inboxes(actor, object_id)
+	cache.add(object_id)
 
-	futures = [misc.request(inbox, data=data) for inbox in inboxes]
-	asyncio.ensure_future(asyncio.gather(*futures))
-
-	cache[object_id] = object_id
+	await app['delivery'].push(inboxes, misc.Payload.new(data))
 
 
 async def handle_follow(actor, data, request):
@@ -62,9 +59,9 @@ async def handle_follow(actor, data, request):
 
 	inbox = misc.get_actor_inbox(actor)
 
-	if inbox not in database.inboxes:
+	if inbox not in database.inbox_set:
 		database.add_inbox(inbox)
-		database.save()
+		database.save_later()
 		asyncio.ensure_future(misc.follow_remote_actor(actor['id']))
 
 	message = {
@@ -103,11 +100,32 @@ async def handle_undo(actor, data, request):
 		return
 
 	database.del_inbox(inbox)
-	database.save()
+	database.save_later()
 
 	await misc.unfollow_remote_actor(actor['id'])
 
 
+def is_duplicate(data):
+	## Follows are always handled, and Undos only get forwarded for Announces
+	if data['type'] not in ['Announce', 'Create', 'Delete', 'Undo', 'Update']:
+		return False
+
+	if data['type'] == 'Undo' and not (isinstance(data['object'], dict) and data['object'].get('type') == 'Announce'):
+		return False
+
+	## the processors use the object id as a url and cache key, so anything else is invalid
+	object_id = misc.distill_object_id(data)
+
+	if not isinstance(object_id, str):
+		raise TypeError(f'Invalid object id: {object_id!r}')
+
+	## Deletes are always forwarded
+	if data['type'] == 'Delete':
+		return False
+
+	return object_id in app['cache'].objects
+
+
 processors = {
 	'Announce': handle_relay,
 	'Create': handle_relay,
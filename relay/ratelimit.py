@@ -0,0 +1,108 @@
+import time
+
+
+## how often to forget buckets of domains that haven't sent anything for a while
+PRUNE_INTERVAL = 60
+
+## activity types limited by each rate
+LIMITED_TYPES = {
+	'Create': 'create',
+	'Announce': 'create',
+	'Delete': 'delete',
+	'Update': 'delete'
+}
+
+
+class InboxLimiter:
+	def __init__(self, config):
+		## kind -> (tokens per second, bucket size)
+		self.rates = {
+			'create': (config.inbox_rate, max(1, config.inbox_burst)),
+			'delete': (config.inbox_delete_rate, max(1, config.inbox_delete_burst))
+		}
+
+		## (domain, kind) -> [tokens, last update]
+		self.buckets = {}
+		self.limited = 0
+		self.last_prune = time.monotonic()
+
+
+	@property
+	def stats(self):
+		now = time.monotonic()
+		buckets = {}
+
+		for (domain, kind), bucket in self.buckets.items():
+			buckets.setdefault(domain, {})[kind] = round(self.refill(kind, bucket, now), 2)
+
+		return {
+			'create_rate': self.rates['create'][0],
+			'delete_rate': self.rates['delete'][0],
+			'limited': self.limited,
+			'buckets': buckets
+		}
+
+
+	def refill(self, kind, bucket, now):
+		rate, burst = self.rates[kind]
+		bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+		bucket[1] = now
+		return bucket[0]
+
+
+	def prune(self, now):
+		self.last_prune = now
+
+		for key, bucket in list(self.buckets.items()):
+			if self.refill(key[1], bucket, now) >= self.rates[key[1]][1]:
+				del self.buckets[key]
+
+
+	def check(self, domain, type, consume=True):
+		## returns 0 if the activity is allowed or the number of seconds until it would be.
+		## without consume, the bucket is only looked at and nothing is taken from it
+		try:
+			kind = LIMITED_TYPES[type]
+
+		except KeyError:
+			return 0
+
+		rate, burst = self.rates[kind]
+
+		if not rate:
+			return 0
+
+		now = time.monotonic()
+
+		if now - self.last_prune > PRUNE_INTERVAL:
+			self.prune(now)
+
+		try:
+			bucket = self.buckets[(domain, kind)]
+
+		except KeyError:
+			if not consume:
+				return 0
+
+			bucket = self.buckets[(domain, kind)] = [burst, now]
+
+		if self.refill(kind, bucket, now) >= 1:
+			if consume:
+				bucket[0] -= 1
+
+			return 0
+
+		self.limited += 1
+		return (1 - bucket[0]) / rate
+
+
+	def refund(self, domain, type):
+		## gives back the token of an activity that was rejected after it had been counted
+		try:
+			kind = LIMITED_TYPES[type]
+			bucket = self.buckets[(domain, kind)]
+
+		except KeyError:
+			return
+
+		bucket[0] = min(self.rates[kind][1], bucket[0] + 1)
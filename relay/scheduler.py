@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+
+
+## failed deliveries are counted over this many seconds. the global limit is only cut when
+## the failures in a window come from at least FAILURE_HOSTS hosts and make up at least
+## FAILURE_RATE of the finished deliveries, so a few dead instances can't hold it down
+FAILURE_WINDOW = 10
+FAILURE_HOSTS = 3
+FAILURE_RATE = 0.05
+
+
+class Waiters:
+	def __init__(self):
+		self.futures = deque()
+
+
+	async def wait(self, timeout=None):
+		future = asyncio.get_event_loop().create_future()
+		self.futures.append(future)
+
+		try:
+			await asyncio.wait_for(future, timeout)
+
+		except asyncio.TimeoutError:
+			pass
+
+
+	def wake(self, count=None):
+		woken = 0
+
+		while self.futures and (count is None or woken < count):
+			future = self.futures.popleft()
+
+			if not future.done():
+				future.set_result(None)
+				woken += 1
+
+
+class HostScheduler:
+	def __init__(self, config):
+		self.host_limit = config.host_limit
+		self.host_rate = config.host_rate
+		self.active = {}
+		self.total = 0
+		self.waiters = Waiters()
+
+		## called with the hostname every time a slot is freed, or None when the limit grows
+		self.listeners = []
+
+		## earliest time the next request to a host may start when a rate is set
+		self.next_start = {}
+
+		## the global limit grows by one for every limit's worth of fast responses and is
+		## cut in half when failures spread over several hosts
+		self.window = config.push_limit
+		self.min_limit = config.push_limit_min
+		self.max_limit = config.push_limit_max
+		self.latency = config.push_latency
+		self.window_start = time.monotonic()
+		self.window_successes = 0
+		self.window_failures = 0
+		self.failed_hosts = set()
+		self.last_decrease = 0
+
+		## hosts with a p95 latency over slow_latency share a separate, smaller limit
+		self.slow_latency = config.slow_latency
+		self.slow_limit = config.slow_limit
+		self.slow_active = {}
+		self.slow_total = 0
+		self.slow = set()
+		self.latencies = {}
+
+
+	@property
+	def limit(self):
+		return int(self.window)
+
+
+	@property
+	def stats(self):
+		return {
+			'active': self.total,
+			'limit': self.limit,
+			'min_limit': self.min_limit,
+			'max_limit': self.max_limit,
+			'host_limit': self.host_limit,
+			'host_rate': self.host_rate,
+			'hosts': len(self.active),
+			'slow_active': self.slow_total,
+			'slow_limit': self.slow_limit,
+			'slow': sorted(self.slow)
+		}
+
+
+	def get_delay(self, host):
+		## returns how long to wait until a request to the host may start, or None if the
+		## global, slow lane or host concurrency limit is reached
+		if self.total >= self.limit or self.active.get(host, 0) >= self.host_limit:
+			return None
+
+		if host in self.slow and self.slow_total >= self.slow_limit:
+			return None
+
+		if not self.host_rate:
+			return 0
+
+		return max(0, self.next_start.get(host, 0) - time.monotonic())
+
+
+	def try_acquire(self, host):
+		if self.get_delay(host) != 0:
+			return False
+
+		self.active[host] = self.active.get(host, 0) + 1
+		self.total += 1
+
+		if host in self.slow:
+			self.slow_active[host] = self.slow_active.get(host, 0) + 1
+			self.slow_total += 1
+
+		if self.host_rate:
+			self.next_start[host] = time.monotonic() + 1 / self.host_rate
+
+		return True
+
+
+	def release(self, host):
+		self.active[host] -= 1
+		self.total -= 1
+
+		if host in self.slow_active:
+			self.slow_active[host] -= 1
+			self.slow_total -= 1
+
+			if not self.slow_active[host]:
+				del self.slow_active[host]
+
+		if not self.active[host]:
+			del self.active[host]
+
+			if self.next_start.get(host, 0) <= time.monotonic():
+				self.next_start.pop(host, None)
+
+		self.notify(host)
+
+
+	def notify(self, host=None):
+		self.waiters.wake()
+
+		for listener in self.listeners:
+			listener(host)
+
+
+	def record_latency(self, host, latency):
+		try:
+			latencies = self.latencies[host]
+
+		except KeyError:
+			latencies = self.latencies[host] = deque(maxlen=20)
+
+		latencies.append(latency)
+
+		if len(latencies) < 5:
+			return
+
+		p95 = sorted(latencies)[int(len(latencies) * 0.95) - 1]
+
+		if p95 > self.slow_latency and host not in self.slow:
+			logging.verbose(f'Moving {host} to the slow lane (p95: {p95:.2f}s)')
+			self.slow.add(host)
+
+		elif p95 <= self.slow_latency and host in self.slow:
+			logging.verbose(f'Moving {host} out of the slow lane (p95: {p95:.2f}s)')
+			self.slow.discard(host)
+
+
+	def reset_window(self, now):
+		self.window_start = now
+		self.window_successes = 0
+		self.window_failures = 0
+		self.failed_hosts.clear()
+
+
+	def record_success(self, latency):
+		now = time.monotonic()
+
+		if now - self.window_start >= FAILURE_WINDOW:
+			self.reset_window(now)
+
+		self.window_successes += 1
+
+		if self.latency and latency > self.latency:
+			return
+
+		limit = self.limit
+		self.window = min(self.max_limit, self.window + 1 / self.window)
+
+		if self.limit > limit:
+			self.notify()
+
+
+	def record_failure(self, host):
+		## slow hosts already have their own limit
+		if host in self.slow:
+			return
+
+		now = time.monotonic()
+
+		if now - self.window_start >= FAILURE_WINDOW:
+			self.reset_window(now)
+
+		self.window_failures += 1
+		self.failed_hosts.add(host)
+
+		if len(self.failed_hosts) < FAILURE_HOSTS:
+			return
+
+		if self.window_failures / (self.window_failures + self.window_successes) < FAILURE_RATE:
+			return
+
+		## give the last cut a window to take effect before cutting again
+		if now - self.last_decrease < FAILURE_WINDOW:
+			return
+
+		logging.verbose(f'Failures from {len(self.failed_hosts)} hosts, lowering limit')
+		self.window = max(self.min_limit, self.window / 2)
+		self.last_decrease = now
+		self.reset_window(now)
+
+
+	async def acquire(self, host):
+		while not self.try_acquire(host):
+			await self.waiters.wait(self.get_delay(host) or None)
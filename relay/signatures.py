@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import multiprocessing
+
+from Crypto.PublicKey import RSA
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .misc import sign_signing_string, verify_signing_string
+
+
+## private key of a signing worker process
+WORKER_KEY = None
+
+
+def init_worker(privkey):
+	global WORKER_KEY
+
+	WORKER_KEY = RSA.importKey(privkey)
+
+
+def sign_worker(sigstring):
+	return sign_signing_string(sigstring, WORKER_KEY)
+
+
+class Signer:
+	def __init__(self, key, workers):
+		self.key = key
+		self.workers = workers
+		self.executor = None
+
+
+	def start(self):
+		## worker processes are spawned instead of forked since the relay has threads
+		## running by the time the first signature is made
+		self.executor = ProcessPoolExecutor(
+			max_workers = self.workers or None,
+			mp_context = multiprocessing.get_context('spawn'),
+			initializer = init_worker,
+			initargs = (self.key.exportKey('PEM'),)
+		)
+
+
+	def stop(self):
+		if self.executor:
+			self.executor.shutdown()
+			self.executor = None
+
+
+	async def sign(self, sigstring):
+		## sign in the event loop when the pool isn't running, like in cli commands
+		if not self.executor:
+			return sign_signing_string(sigstring, self.key)
+
+		loop = asyncio.get_event_loop()
+		executor = self.executor
+
+		try:
+			return await loop.run_in_executor(executor, sign_worker, sigstring)
+
+		## a worker died and took the pool down with it, so start a new one. this signature
+		## is made here so the request doesn't have to wait for the new workers
+		except BrokenProcessPool:
+			if self.executor is executor:
+				logging.warning('Signing worker died, restarting the pool')
+				executor.shutdown(wait=False)
+				self.start()
+
+			return sign_signing_string(sigstring, self.key)
+
+
+class Verifier:
+	def __init__(self, workers):
+		## pycryptodome releases the gil while doing the rsa math, so threads are enough
+		self.executor = ThreadPoolExecutor(max_workers=workers or None)
+		self.counts = defaultdict(lambda: defaultdict(int))
+
+
+	@property
+	def stats(self):
+		return self.counts
+
+
+	def stop(self):
+		self.executor.shutdown()
+
+
+	async def verify(self, verifier, algorithm, sigstring, sigdata):
+		loop = asyncio.get_event_loop()
+
+		try:
+			result = await loop.run_in_executor(self.executor, verify_signing_string, sigstring, sigdata, verifier, algorithm)
+
+		## unknown hash algorithm
+		except KeyError:
+			self.counts[algorithm]['unsupported'] += 1
+			return False
+
+		self.counts[algorithm]['valid' if result else 'invalid'] += 1
+		return result
@@ -0,0 +1,182 @@
+import asyncio
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakValueDictionary
+
+from .misc import Payload
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	type TEXT,
+	body BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS deliveries (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	inbox TEXT NOT NULL,
+	message INTEGER NOT NULL REFERENCES messages(id),
+	attempts INTEGER NOT NULL DEFAULT 0,
+	next_attempt REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS deliveries_next_attempt ON deliveries(next_attempt);
+"""
+
+
+class DeliverySpool:
+	def __init__(self, path):
+		self.path = path
+		self.conn = None
+
+		## payloads of messages that still have deliveries in the queue, so loading more of
+		## their deliveries doesn't load the body again
+		self.payloads = WeakValueDictionary()
+
+		## sqlite connections can only be used by one thread at a time, so all queries
+		## go through a single worker thread to keep them off the event loop
+		self.executor = ThreadPoolExecutor(max_workers=1)
+
+
+	async def run(self, func, *args):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.executor, func, *args)
+
+
+	async def open(self):
+		await self.run(self._open)
+
+
+	async def close(self):
+		await self.run(self._close)
+		self.executor.shutdown()
+
+
+	async def add(self, inboxes, payload):
+		return await self.run(self._add, inboxes, payload)
+
+
+	async def remove(self, job_id):
+		await self.run(self._remove, job_id)
+
+
+	async def reschedule(self, job_id, attempts, next_attempt):
+		await self.run(self._reschedule, job_id, attempts, next_attempt)
+
+
+	async def due(self, limit, after=None):
+		return await self.run(self._due, limit, after)
+
+
+	async def count(self):
+		return await self.run(self._count)
+
+
+	def _open(self):
+		self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.executescript(SCHEMA)
+
+		## clean up messages left over from deliveries finished before the last shutdown
+		self.conn.execute('DELETE FROM messages WHERE id NOT IN (SELECT message FROM deliveries)')
+
+
+	def _close(self):
+		self.conn.close()
+
+
+	def _add(self, inboxes, payload):
+		if not inboxes:
+			return []
+
+		now = time.time()
+
+		with self.conn:
+			self.conn.execute('BEGIN')
+			message_id = self.conn.execute(
+				'INSERT INTO messages (type, body) VALUES (?, ?)',
+				(payload.type, payload.body)
+			).lastrowid
+
+			jobs = []
+
+			for inbox in inboxes:
+				job_id = self.conn.execute(
+					'INSERT INTO deliveries (inbox, message, next_attempt) VALUES (?, ?, ?)',
+					(inbox, message_id, now)
+				).lastrowid
+
+				jobs.append((job_id, inbox))
+
+		return jobs
+
+
+	def _remove(self, job_id):
+		with self.conn:
+			self.conn.execute('BEGIN')
+			row = self.conn.execute('SELECT message FROM deliveries WHERE id = ?', (job_id,)).fetchone()
+			self.conn.execute('DELETE FROM deliveries WHERE id = ?', (job_id,))
+
+			if row:
+				self.conn.execute(
+					'DELETE FROM messages WHERE id = ? AND NOT EXISTS (SELECT 1 FROM deliveries WHERE message = ?)',
+					(row[0], row[0])
+				)
+
+
+	def _reschedule(self, job_id, attempts, next_attempt):
+		self.conn.execute(
+			'UPDATE deliveries SET attempts = ?, next_attempt = ? WHERE id = ?',
+			(attempts, next_attempt, job_id)
+		)
+
+
+	def _due(self, limit, after):
+		## returns up to limit due deliveries ordered by (next_attempt, id) and the key of the
+		## last one to continue from, or None if there are no more
+		if after:
+			rows = self.conn.execute(
+				'''SELECT id, inbox, attempts, message, next_attempt FROM deliveries
+				WHERE next_attempt <= ? AND (next_attempt, id) > (?, ?)
+				ORDER BY next_attempt, id LIMIT ?''',
+				(time.time(), after[0], after[1], limit)
+			).fetchall()
+
+		else:
+			rows = self.conn.execute(
+				'''SELECT id, inbox, attempts, message, next_attempt FROM deliveries
+				WHERE next_attempt <= ? ORDER BY next_attempt, id LIMIT ?''',
+				(time.time(), limit)
+			).fetchall()
+
+		## each message body is loaded once and shared by all of its deliveries
+		payloads = {}
+		missing = set()
+
+		for row in rows:
+			if row[3] in payloads or row[3] in missing:
+				continue
+
+			try:
+				payloads[row[3]] = self.payloads[row[3]]
+
+			except KeyError:
+				missing.add(row[3])
+
+		if missing:
+			query = 'SELECT id, type, body FROM messages WHERE id IN ({})'.format(','.join('?' * len(missing)))
+
+			for message_id, type, body in self.conn.execute(query, tuple(missing)):
+				payloads[message_id] = self.payloads[message_id] = Payload(body, type)
+
+		jobs = [(job_id, inbox, payloads[message_id], attempts) for job_id, inbox, attempts, message_id, _ in rows]
+		after = (rows[-1][4], rows[-1][0]) if len(rows) == limit else None
+		return jobs, after
+
+
+	def _count(self):
+		return self.conn.execute('SELECT COUNT(*) FROM deliveries').fetchone()[0]
@@ -1,13 +1,16 @@
+import base64
+import json
 import logging
+import math
 import subprocess
 import traceback
 
-from aiohttp.web import HTTPForbidden, HTTPUnauthorized, Response, json_response
+from aiohttp.web import HTTPBadRequest, HTTPException, HTTPForbidden, HTTPRequestEntityTooLarge, HTTPServiceUnavailable, HTTPTooManyRequests, HTTPUnauthorized, Response, json_response
 from urllib.parse import urlparse
 
 from . import __version__, app, misc
 from .http_debug import STATS
-from .processors import run_processor
+from .processors import is_duplicate, run_processor
 
 
 try:
@@ -83,9 +86,39 @@ async def inbox(request):
 		logging.verbose('Actor missing signature header')
 		raise HTTPUnauthorized(body='missing signature')
 
+	## reject if the message is too big before reading any of it
+	if request.content_length and request.content_length > config.inbox_max_size:
+		logging.verbose(f'Message too big: {request.content_length} bytes')
+		raise HTTPRequestEntityTooLarge(config.inbox_max_size, request.content_length)
+
+	## reject if the signature doesn't cover the digest, or it could be sent again with any body
+	signed_headers = misc.split_signature(request.headers['signature'])['headers']
+
+	if 'digest' not in signed_headers or 'digest' not in request.headers:
+		logging.verbose('Signature does not cover the digest')
+		raise HTTPUnauthorized(body='digest not signed')
+
+	## the body is hashed while it's read so it can be checked against the digest header
+	digest = misc.parse_digest(request.headers['digest'])
+
+	if not digest:
+		logging.verbose(f'Unsupported digest: {request.headers["digest"]}')
+		raise HTTPBadRequest(body='unsupported digest')
+
+	body = await misc.read_body(request, config.inbox_max_size + 1, digest[0])
+
+	if len(body) > config.inbox_max_size:
+		logging.verbose('Message too big')
+		raise HTTPRequestEntityTooLarge(config.inbox_max_size, len(body))
+
+	## reject if the body doesn't match the digest
+	if base64.b64encode(digest[0].digest()).decode('utf-8') != digest[1]:
+		logging.verbose('Message body does not match digest')
+		raise HTTPUnauthorized(body='digest mismatch')
+
 	## read message and get actor id and domain
 	try:
-		data = await request.json()
+		data = json.loads(body)
 		actor_id = data['actor']
 		actor_domain = urlparse(actor_id).hostname
 
@@ -99,23 +132,120 @@ async def inbox(request):
 		logging.verbose('Failed to parse inbox message')
 		raise HTTPUnauthorized(body='failed to parse message')
 
-	actor = await misc.request(actor_id)
+	## reject if the actor isn't a url with a hostname
+	if not actor_domain:
+		logging.verbose(f'Invalid actor in message: {actor_id}')
+		raise HTTPUnauthorized(body='invalid actor')
 
-	## reject if actor is empty
-	if not actor:
-		logging.verbose(f'Failed to fetch actor: {actor_id}')
-		raise HTTPUnauthorized('failed to fetch actor')
+	## cheap checks that only use the message and config go first, so rejected requests
+	## don't cost a fetch of the actor or a signature check
 
-	## reject if the actor isn't whitelisted while the whiltelist is enabled
-	elif config.whitelist_enabled and not config.is_whitelisted(actor_id):
-		logging.verbose(f'Rejected actor for not being in the whitelist: {actor_id}')
-		raise HTTPForbidden(body='access denied')
+	## reject if the message has no type
+	if 'type' not in data:
+		logging.verbose(f'Message from actor has no type: {actor_id}')
+		raise HTTPBadRequest(body='no type in message')
+
+	## reject if headers included in the signature are missing
+	if any(header not in request.headers for header in signed_headers if header != '(request-target)'):
+		logging.verbose(f'Signed headers missing from request: {actor_id}')
+		raise HTTPUnauthorized(body='missing signed headers')
 
 	## reject if actor is banned
-	if app['config'].is_banned(actor_id):
+	if config.is_banned(actor_id):
 		logging.verbose(f'Ignored request from banned actor: {actor_id}')
 		raise HTTPForbidden(body='access denied')
 
+	## reject if the actor isn't whitelisted while the whiltelist is enabled
+	if config.whitelist_enabled and not config.is_whitelisted(actor_id):
+		logging.verbose(f'Rejected actor for not being in the whitelist: {actor_id}')
+		raise HTTPForbidden(body='access denied')
+
+	## reject if activity type isn't 'Follow' and the actor isn't following
+	if data['type'] != 'Follow' and not database.get_inbox(actor_domain):
+		logging.verbose(f'Rejected actor for trying to post while not following: {actor_id}')
+		raise HTTPUnauthorized(body='access denied')
+
+	## reject if the instance has already used up its rate limit. the message isn't verified
+	## yet, so it only counts against the instance if the signature turns out to be valid
+	check_rate_limit(actor_domain, data['type'], consume=False)
+
+	## accept objects that were already relayed without checking them again. the processors
+	## wouldn't do anything with them anyway
+	try:
+		if is_duplicate(data):
+			logging.verbose(f'Ignoring already relayed {data["type"]} from {actor_id}')
+			return Response(body=b'{}', content_type='application/activity+json')
+
+	except (KeyError, TypeError):
+		logging.verbose(f'Invalid object in message from {actor_id}')
+		raise HTTPBadRequest(body='invalid object')
+
+	if config.inbox_mode == 'sync':
+		await process_inbox(request, data)
+		return Response(body=b'{}', content_type='application/activity+json')
+
+	## the sender won't hear back from the background checks, so the activity is counted now
+	## and given back if it turns out to be forged
+	check_rate_limit(actor_domain, data['type'])
+	request['rate_counted'] = True
+
+	## the rest of the checks are done in the background, so tell the sender to try
+	## again later when too much is waiting already
+	if not app['inbox'].push(request, data):
+		logging.verbose(f'Inbox queue full, rejecting {data["type"]} from {actor_id}')
+		app['limiter'].refund(actor_domain, data['type'])
+		raise HTTPServiceUnavailable(
+			body='too many messages, try again later',
+			headers={'Retry-After': str(config.inbox_retry_after)}
+		)
+
+	return Response(body=b'{}', status=202, content_type='application/activity+json')
+
+
+def check_rate_limit(domain, type, consume=True):
+	wait = app['limiter'].check(domain, type, consume)
+
+	if wait:
+		logging.verbose(f'Rate limited {type} from {domain}')
+		raise HTTPTooManyRequests(
+			body='rate limit exceeded',
+			headers={'Retry-After': str(math.ceil(wait))}
+		)
+
+
+async def process_inbox(request, data):
+	actor_domain = urlparse(data['actor']).hostname
+
+	try:
+		actor = await verify_inbox(request, data)
+
+	except HTTPException:
+		if request.get('rate_counted'):
+			app['limiter'].refund(actor_domain, data['type'])
+
+		raise
+
+	## reject if the instance is sending more than its share of activities. each one goes
+	## out to every subscriber, so this is cheaper here than after fanout
+	if not request.get('rate_counted'):
+		check_rate_limit(actor_domain, data['type'])
+
+	logging.debug(f">> payload {data}")
+
+	await run_processor(request, data, actor)
+
+
+async def verify_inbox(request, data):
+	config = app['config']
+	actor_id = data['actor']
+	actor_domain = urlparse(actor_id).hostname
+	actor = await misc.fetch_actor(actor_id)
+
+	## reject if actor is empty
+	if not actor:
+		logging.verbose(f'Failed to fetch actor: {actor_id}')
+		raise HTTPUnauthorized(body='failed to fetch actor')
+
 	## reject if software used by actor is banned
 	if len(config.blocked_software):
 		software = await misc.fetch_nodeinfo(actor_domain)
@@ -129,15 +259,7 @@ async def inbox(request):
 		logging.verbose(f'signature validation failed for: {actor_id}')
 		raise HTTPUnauthorized(body='signature check failed, signature did not match key')
 
-	## reject if activity type isn't 'Follow' and the actor isn't following
-	if data['type'] != 'Follow' and not database.get_inbox(actor_domain):
-		logging.verbose(f'Rejected actor for trying to post while not following: {actor_id}')
-		raise HTTPUnauthorized(body='access denied')
-
-	logging.debug(f">> payload {data}")
-
-	await run_processor(request, data, actor)
-	return Response(body=b'{}', content_type='application/activity+json')
+	return actor
 
 
 async def webfinger(request):
@@ -200,4 +322,15 @@ async def nodeinfo_wellknown(request):
 
 
 async def stats(request):
-    return json_response(STATS)
+	data = dict(STATS)
+	data['delivery'] = app['delivery'].stats
+	data['scheduler'] = app['scheduler'].stats
+	data['breaker'] = app['breaker'].stats
+	data['verifier'] = app['verifier'].stats
+	data['limiter'] = app['limiter'].stats
+	data['objects'] = app['cache'].objects.stats
+
+	if 'inbox' in app:
+		data['inbox'] = app['inbox'].stats
+
+	return json_response(data)